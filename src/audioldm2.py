@@ -1,5 +1,7 @@
 from typing import Any, Callable, Dict, List, Optional, Union
+from collections import OrderedDict
 import os
+import functools
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -107,46 +109,211 @@ schedular_config = """
 """
 
 
+def _memory_format(x):  # buffer를 x와 같은 memory format으로 할당하기 위함
+    if x.dim() == 4 and x.is_contiguous(memory_format=torch.channels_last) and not x.is_contiguous():
+        return torch.channels_last
+    return torch.contiguous_format
+
+
+@torch.jit.script
+def _ddim_inv_step(x: torch.Tensor, eps: torch.Tensor, coef_x: torch.Tensor, coef_eps: torch.Tensor) -> torch.Tensor:
+    # (x - sqrt(1-a_t)*eps) * sqrt(a_tn)/sqrt(a_t) + sqrt(1-a_tn)*eps == coef_x*x + coef_eps*eps (하나의 elementwise kernel로 fuse)
+    return x * coef_x + eps * coef_eps
+
+
 class AudioLDM2(nn.Module):
     
     def __init__(self, device='cuda', repo_id="cvssp/audioldm2-large", config=None):
         super().__init__()
         self.device = torch.device(device)
-        pipe = AudioLDM2Pipeline.from_pretrained(repo_id, use_safetensors=False)
+
+        # bf16 tensor core가 있는 GPU(Ampere, sm80 이상)면 weight를 처음부터 bf16으로 load (scheduler 연산은 FP32 유지)
+        # is_bf16_supported()는 emulation도 True로 보고(T4/V100) 현재 device를 보므로, self.device의 compute capability로 판단
+        bf16_ok = self.device.type == 'cuda' and torch.cuda.is_available() \
+            and torch.cuda.get_device_capability(self.device)[0] >= 8
+        self.autocast_dtype = torch.bfloat16 if bf16_ok else torch.float32
+        # use_safetensors 미지정: safetensors가 있으면 사용, 없으면 .bin으로 fallback
+        pipe = AudioLDM2Pipeline.from_pretrained(repo_id, torch_dtype=self.autocast_dtype)
 
         # Setup components and move to device
         self.pipe = pipe.to(self.device)
 
         self.vae = self.pipe.vae
         self.scheduler = self.pipe.scheduler
-        self.vocoder = self.pipe.vocoder
+        self.vocoder = self.pipe.vocoder.to(torch.float32)  # HiFi-GAN vocoder는 FP32 유지
         self.tokenizer = self.pipe.tokenizer
         self.text_encoder = self.pipe.text_encoder
         self.unet = self.pipe.unet
 
+        # Conv 위주의 UNet/VAE는 NHWC(channels_last)로 (latent: ts[B, C:8, lT:256, lM:16])
+        self.unet = self.unet.to(memory_format=torch.channels_last)
+        self.vae = self.vae.to(memory_format=torch.channels_last)
+
+        # torch.compile (UNet / VAE encode, decode)
+        # batch 크기가 바뀌면 (e.g. edit_mels_batched의 K*B와 inference의 B) 크기별로 recompile / CUDA graph capture됨
+        self.compile_model = False if not config else config.get('compile_model', False)
+        if self.compile_model:
+            self.unet = torch.compile(self.unet, mode="reduce-overhead", fullgraph=False)
+            self.vae.decode = torch.compile(self.vae.decode, mode="reduce-overhead", fullgraph=False)
+            self.vae.encode = torch.compile(self.vae.encode, mode="reduce-overhead", fullgraph=False)
+
+        self._lmi_bufs = {}  # CFG용 latent_model_input 버퍼 ts[2B, C:8, lT:256, lM:16] (shape/dtype/device별)
+        self._noise_out_bufs = {}  # CFG guidance 결과 버퍼 ts[B, C:8, lT:256, lM:16] (shape/dtype/device별)
+
+        # ddim_noising 전용 RNG / noise 버퍼 (config['seed']가 있으면 고정)
+        # 없으면 global RNG에서 seed를 뽑아 torch.manual_seed(...)로 재현 가능하게 유지
+        self._noise_gen = torch.Generator(device=self.device)
+        if config and config.get('seed') is not None:
+            self._noise_gen.manual_seed(int(config['seed']))
+        else:
+            self._noise_gen.manual_seed(int(torch.randint(0, 2**62, (1,)).item()))
+        self._noise_bufs = {}  # noise 버퍼 ts[B, C:8, lT:256, lM:16] (shape/dtype/device별)
+
+        # text별 encoder 출력 cache: (text, T5 길이) -> (T5 embeds, T5 attention mask, GPT2 generated embeds)
+        self._prompt_cache = OrderedDict()
+        self._prompt_cache_size = 32
+        self._t5_lengths = {}  # text -> padding 없는 T5 token 수 (encode_prompt마다 다시 tokenize하지 않도록)
 
         self.evalmode = True
         self.checkpoint_path = repo_id
         self.audio_duration = 10.24 if not config else config['duration']
         self.original_waveform_length = int(self.audio_duration * self.vocoder.config.sampling_rate)  # 10.24 * 16000 = 163840
         self.vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)  # 4
+        self._scaling = self.vae.config.scaling_factor
+        self._inv_scaling = 1.0 / self.vae.config.scaling_factor
         print(f'[INFO] audioldm.py: loaded AudioLDM!')
 
     def eval_(self):
         self.evalmode = True
+        self._prompt_cache.clear()
+        self._t5_lengths.clear()
 
     def train_(self):
         self.evalmode = False
+        self._prompt_cache.clear()
+        self._t5_lengths.clear()
+
+    def _autocast(self):
+        return torch.autocast(self.device.type, dtype=self.autocast_dtype, enabled=self.autocast_dtype != torch.float32)
+
+    def _cfg_latent_input(self, latents):  # ts[B, C:8, lT:256, lM:16] -> ts[2B, C:8, lT:256, lM:16]
+        memory_format = _memory_format(latents)
+        key = (tuple(latents.shape), latents.dtype, latents.device, memory_format)
+        buf = self._lmi_bufs.get(key)
+        if buf is None:
+            buf = self._lmi_bufs[key] = torch.empty((2 * latents.size(0), *latents.shape[1:]), dtype=latents.dtype,
+                                                    device=latents.device, memory_format=memory_format)
+        # torch.cat([latents] * 2) 대신 expand한 view를 기존 버퍼에 복사
+        buf.view(2, *latents.shape).copy_(latents.unsqueeze(0).expand(2, *latents.shape))
+        return buf
+
+    def _cfg_guidance(self, noise_pred, guidance_scale):  # ts[2B, C:8, lT:256, lM:16] -> ts[B, C:8, lT:256, lM:16]
+        # uncond + w * (cond - uncond) == lerp(uncond, cond, w)
+        B = noise_pred.size(0) // 2
+        memory_format = _memory_format(noise_pred)
+        key = (tuple(noise_pred.shape), noise_pred.dtype, noise_pred.device, memory_format)
+        out = self._noise_out_bufs.get(key)
+        if out is None:
+            out = self._noise_out_bufs[key] = torch.empty((B, *noise_pred.shape[1:]), dtype=noise_pred.dtype,
+                                                          device=noise_pred.device, memory_format=memory_format)
+        noise_pred_uncond, noise_pred_text = noise_pred.view(2, B, *noise_pred.shape[1:]).unbind(0)
+        torch.lerp(noise_pred_uncond, noise_pred_text, guidance_scale, out=out)
+        return out
+
+    @torch.no_grad()
+    def encode_prompt(self, prompts: List[str], batch_size: int = 1):  # -> ts[2*K*B, L, 1024], ts[2*K*B, L], ts[2*K*B, 8, 768]
+        # text별 encoder 출력(cache)을 batch로 조립: [u0]*B + [u1]*B + ... + [p0]*B + [p1]*B + ...
+        # 각 prompt와 그 uncond ""는 prompt 자신의 T5 길이로 padding해서 encode (pipe.encode_prompt([p])와 동일)
+        # -> 같은 batch의 다른 prompt가 GPT2 position(= generated embeds)에 영향을 주지 않음
+        # encode 후 T5 embeds/mask만 batch 내 최대 길이로 0-padding (UNet에서 encoder_attention_mask_1로 mask됨)
+        lengths = [self._t5_length(text) for text in prompts]
+        entries = [self._encode_text("", length) for length in lengths]  # "": CFG용 uncond
+        entries += [self._encode_text(text, length) for text, length in zip(prompts, lengths)]
+        max_length = max(lengths)
+        prompt_embeds = torch.cat([F.pad(e[0], (0, 0, 0, max_length - e[0].size(1))) for e in entries])
+        attention_mask = torch.cat([F.pad(e[1], (0, max_length - e[1].size(1))) for e in entries])
+        generated_prompt_embeds = torch.cat([e[2] for e in entries])  # GPT2 출력은 항상 8 token
+        prompt_embeds = prompt_embeds.repeat_interleave(batch_size, dim=0)
+        attention_mask = attention_mask.repeat_interleave(batch_size, dim=0)
+        generated_prompt_embeds = generated_prompt_embeds.repeat_interleave(batch_size, dim=0)
+        return prompt_embeds, attention_mask, generated_prompt_embeds
+
+    def _t5_length(self, text: str):  # padding 없이 tokenize했을 때의 T5 token 수 (text별 memo)
+        length = self._t5_lengths.get(text)
+        if length is None:
+            tokenizer_2 = self.pipe.tokenizer_2
+            length = len(tokenizer_2(text, max_length=tokenizer_2.model_max_length, truncation=True).input_ids)
+            self._t5_lengths[text] = length
+        return length
+
+    def _encode_text(self, text: str, max_length: int):  # -> ts[1, L, 1024], ts[1, L], ts[1, 8, 768]  (L: max_length)
+        # 같은 (text, T5 길이)는 CLAP / T5 / projection / GPT2를 다시 돌리지 않고 cache 사용 (최대 32개, LRU)
+        key = (text, max_length)
+        if key in self._prompt_cache:
+            self._prompt_cache.move_to_end(key)
+            return self._prompt_cache[key]
+
+        pipe = self.pipe
+        clap_inputs = self.tokenizer(
+            text,
+            padding="max_length",
+            max_length=self.tokenizer.model_max_length,
+            truncation=True,
+            return_tensors="pt",
+        )
+        t5_inputs = pipe.tokenizer_2(
+            text,
+            padding="max_length",
+            max_length=max_length,
+            truncation=True,
+            return_tensors="pt",
+        )
+        clap_ids, clap_mask = clap_inputs.input_ids.to(self.device), clap_inputs.attention_mask.to(self.device)
+        t5_ids, t5_mask = t5_inputs.input_ids.to(self.device), t5_inputs.attention_mask.to(self.device)
+
+        # CLAP: ts[1, 512] -> ts[1, 1, 512], 이 하나의 hidden-state에만 attend
+        clap_embeds = self.text_encoder.get_text_features(clap_ids, attention_mask=clap_mask)[:, None, :]
+        clap_mask = clap_mask.new_ones((1, 1))
+        # T5: ts[1, L, 1024]
+        t5_embeds = pipe.text_encoder_2(t5_ids, attention_mask=t5_mask)[0]
+
+        projection_output = pipe.projection_model(
+            hidden_states=clap_embeds,
+            hidden_states_1=t5_embeds,
+            attention_mask=clap_mask,
+            attention_mask_1=t5_mask,
+        )
+        # GPT2: ts[1, 8, 768]
+        generated_embeds = pipe.generate_language_model(
+            projection_output.hidden_states,
+            attention_mask=projection_output.attention_mask,
+            max_new_tokens=None,
+        )
+
+        encoded = (
+            t5_embeds.to(dtype=pipe.text_encoder_2.dtype),
+            t5_mask,
+            generated_embeds.to(dtype=pipe.language_model.dtype),
+        )
+        self._prompt_cache[key] = encoded
+        if len(self._prompt_cache) > self._prompt_cache_size:
+            self._prompt_cache.popitem(last=False)
+        return encoded
 
     def encode_audios(self, x):  # ts[B, 1, T:1024, M:64] -> ts[B, C:8, lT:256, lM:16]
-        encoder_posterior = self.vae.encode(x)
-        unscaled_z = encoder_posterior.latent_dist.sample()
-        z = unscaled_z * self.vae.config.scaling_factor  # Normalize z to have std=1 / factor: 0.9227914214134216
+        with self._autocast():
+            encoder_posterior = self.vae.encode(x)
+            unscaled_z = encoder_posterior.latent_dist.sample()
+        # sample()이 새로 만든 tensor이므로 in-place scaling
+        z = unscaled_z.float().mul_(self._scaling)  # Normalize z to have std=1 / factor: 0.9227914214134216
+        z = z.contiguous(memory_format=torch.channels_last)
         return z
 
     def decode_latents(self, latents):  # ts[B, C:8, lT:256, lM:16] -> ts[B, 1, T:1024, M:64]
-        latents = 1 / self.vae.config.scaling_factor * latents
-        mel_spectrogram = self.vae.decode(latents).sample
+        with self._autocast():
+            mel_spectrogram = self.vae.decode(latents * self._inv_scaling).sample  # 입력 latents는 변경하지 않음
+        # compile(reduce-overhead) 시 decode 출력은 CUDA graph 소유 -> 다음 replay에 덮어써지므로 항상 복사
+        mel_spectrogram = mel_spectrogram.to(torch.float32, copy=self.compile_model)
         return mel_spectrogram
 
     def mel_to_waveform(self, mel_spectrogram):  # ts[B, 1, T:1024, M:64] -> ts[B, N:163872]
@@ -155,7 +322,7 @@ class AudioLDM2(nn.Module):
         elif mel_spectrogram.dim() == 2:
             mel_spectrogram = mel_spectrogram.unsqueeze(0)
         assert mel_spectrogram.dim() == 3, mel_spectrogram.dim()
-        waveform = self.vocoder(mel_spectrogram)  # ts[B,163872]
+        waveform = self.vocoder(mel_spectrogram.float())  # ts[B,163872]
         # we always cast to float32 as this does not cause significant overhead and is compatible with bfloat16
         waveform = waveform[:, :self.original_waveform_length]
         waveform = waveform.cpu().float()
@@ -190,7 +357,11 @@ class AudioLDM2(nn.Module):
         self.scheduler.config.steps_offset = old_offset
         
         ##
-        noise = torch.randn_like(noisy_latents)
+        key = (tuple(noisy_latents.shape), noisy_latents.dtype, noisy_latents.device, _memory_format(noisy_latents))
+        noise_buf = self._noise_bufs.get(key)
+        if noise_buf is None:
+            noise_buf = self._noise_bufs[key] = torch.empty_like(noisy_latents)
+        noise = noise_buf.normal_(generator=self._noise_gen)
         noisy_latents = self.scheduler.add_noise(noisy_latents, noise, all_timesteps[-t_enc])
         ##
 
@@ -229,36 +400,41 @@ class AudioLDM2(nn.Module):
         used_timesteps = all_timesteps[-t_enc:]
         
         extra_step_kwargs = self.pipe.prepare_extra_step_kwargs(generator=None, eta=0.0)  # DDIM eta 설정
+        # eta=0.0, generator=None은 DDIMScheduler.step의 기본값 -> step마다 넘길 필요 없음
+        extra_step_kwargs = {k: v for k, v in extra_step_kwargs.items() if not (v is None or v == 0.0)}
+        scheduler_step = functools.partial(self.scheduler.step, **extra_step_kwargs) if extra_step_kwargs else self.scheduler.step
 
         num_warmup_steps = len(used_timesteps) - t_enc * self.scheduler.order
 
-        for i, t in enumerate(used_timesteps):
-            # expand latents if classifier free guidance
-            latent_model_input = (torch.cat([latents] * 2) if do_cfg else latents)
-            latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
+        try:
+            for i, t in enumerate(used_timesteps):
+                # expand latents if classifier free guidance
+                latent_model_input = (self._cfg_latent_input(latents) if do_cfg else latents)
+                latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
             
-            # predict noise
-            noise_pred = self.unet(
-                latent_model_input, t,
-                encoder_hidden_states=generated_prompt_embeds,
-                encoder_hidden_states_1=prompt_embeds,
-                encoder_attention_mask_1=attention_mask,
-            ).sample
-
-            # guidance
-            if do_cfg:
-                noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
-
-            # DDIMScheduler의 step
-            latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
-
-            # callback
-            if i == len(used_timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
-                if callback is not None and i % callback_steps == 0:
-                    step_idx = i // getattr(self.scheduler, "order", 1)
-                    callback(step_idx, t, latents)
-
+                # predict noise
+                with self._autocast():
+                    noise_pred = self.unet(
+                        latent_model_input, t,
+                        encoder_hidden_states=generated_prompt_embeds,
+                        encoder_hidden_states_1=prompt_embeds,
+                        encoder_attention_mask_1=attention_mask,
+                    ).sample
+                noise_pred = noise_pred.float()  # scheduler step은 FP32
+
+                # guidance
+                if do_cfg:
+                    noise_pred = self._cfg_guidance(noise_pred, guidance_scale)
+
+                # DDIMScheduler의 step
+                latents = scheduler_step(noise_pred, t, latents).prev_sample
+
+                # callback
+                if i == len(used_timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
+                    if callback is not None and i % callback_steps == 0:
+                        step_idx = i // getattr(self.scheduler, "order", 1)
+                        callback(step_idx, t, latents)
+        finally:
             self.scheduler.config.steps_offset = old_offset
 
         return latents
@@ -290,21 +466,52 @@ class AudioLDM2(nn.Module):
         # # 재현성을 위한 seed 설정
         # seed_everything(int(seed))
 
+        # ========== text -> prompt embeddings ==========
+        prompts = [text] if isinstance(text, str) else list(text)
+        prompt_embeds, attention_mask, generated_prompt_embeds = self.encode_prompt(prompts, batch_size=batch_size)
+        assert prompt_embeds.size(0) == 2 * len(prompts) * batch_size, (prompt_embeds.shape, len(prompts), batch_size)
+
+        return self.edit_audio_with_ddim_batched(
+            mel=mel,
+            prompt_embeds=prompt_embeds,
+            attention_mask=attention_mask,
+            generated_prompt_embeds=generated_prompt_embeds,
+            duration=duration,
+            transfer_strength=transfer_strength,
+            guidance_scale=guidance_scale,
+            ddim_steps=ddim_steps,
+            return_type=return_type,
+            clipping=clipping,
+        )
+
+    def edit_audio_with_ddim_batched(  # ts[N, 1, T:1024, M:64] -> mel/wav
+        self,
+        mel: torch.Tensor,
+        prompt_embeds: torch.Tensor,
+        attention_mask: torch.Tensor,
+        generated_prompt_embeds: torch.Tensor,
+        duration: float,
+        transfer_strength: float,
+        guidance_scale: float,
+        ddim_steps: int,
+        return_type: str = "ts",  # "ts" or "np" or "mel"
+        clipping = False,
+    ):
+        r"""
+        - prompt_embeds, attention_mask, generated_prompt_embeds: `encode_prompt`의 출력 ([uncond; cond], 크기 2N).
+          mel의 각 row마다 다른 prompt를 줄 수 있어 여러 sample을 한 번에 UNet에 통과시킬 수 있음.
+        """
+        assert self.evalmode, "Let mode be eval"
+
         # ========== mel -> latents ==========
         assert mel.dim() == 4, mel.dim()
+        for embeds in (prompt_embeds, attention_mask, generated_prompt_embeds):
+            assert embeds.size(0) == 2 * mel.size(0), (embeds.shape, mel.shape)
         init_latent_x = self.encode_audios(mel)
         
-        if torch.max(torch.abs(init_latent_x)) > 1e2:
-            init_latent_x = torch.clamp(init_latent_x, min=-10.0, max=10.0)  # clipping
+        init_latent_x.clamp_(min=-10.0, max=10.0)  # clipping (in-place, reduction/sync 없음)
 
         # ========== DDIM Inversion (noising) ==========
-        prompt_embeds, attention_mask, generated_prompt_embeds = self.pipe.encode_prompt(
-            prompt=[text]*batch_size, 
-            device=self.device, 
-            do_classifier_free_guidance=True,
-            num_waveforms_per_prompt=1,
-            )
-
         # t_enc step으로 ddim noising
         noisy_latents = self.ddim_noising(
             latents=init_latent_x,
@@ -371,21 +578,17 @@ class AudioLDM2(nn.Module):
         # ========== mel -> latents ==========
         assert mel.dim() == 4, mel.dim()
         init_latent_x = self.encode_audios(mel)
-        if torch.max(torch.abs(init_latent_x)) > 1e2:
-            init_latent_x = torch.clamp(init_latent_x, min=-10.0, max=10.0)  # clipping
+        init_latent_x.clamp_(min=-10.0, max=10.0)  # clipping (in-place, reduction/sync 없음)
         # ========== DDIM Inversion (noising) ==========
-        ori_prompt_embeds, ori_attention_mask, ori_generated_prompt_embeds = self.pipe.encode_prompt(
-            prompt=[original_text]*batch_size, 
-            device=self.device, 
-            do_classifier_free_guidance=True,
-            num_waveforms_per_prompt=1,
-            )
-        prompt_embeds, attention_mask, generated_prompt_embeds = self.pipe.encode_prompt(
-            prompt=[text]*batch_size, 
-            device=self.device, 
-            do_classifier_free_guidance=True,
-            num_waveforms_per_prompt=1,
-            )
+        # original_text == text이면 두 번째 호출은 cache hit
+        ori_prompts = [original_text] if isinstance(original_text, str) else list(original_text)
+        prompts = [text] if isinstance(text, str) else list(text)
+        ori_prompt_embeds, ori_attention_mask, ori_generated_prompt_embeds = self.encode_prompt(ori_prompts, batch_size=batch_size)
+        prompt_embeds, attention_mask, generated_prompt_embeds = self.encode_prompt(prompts, batch_size=batch_size)
+        # 이미 CFG로 [uncond; cond] 순서로 concat되어 있음
+        for embeds in (ori_prompt_embeds, ori_attention_mask, ori_generated_prompt_embeds,
+                       prompt_embeds, attention_mask, generated_prompt_embeds):
+            assert embeds.size(0) == 2 * batch_size, (embeds.shape, batch_size)
         
         # ddim_inversion
         noisy_latents = self.ddim_inversion(
@@ -447,31 +650,36 @@ class AudioLDM2(nn.Module):
         start_timestep = int(transfer_strength * num_inference_steps)
         latents = start_latents.clone()
         self.scheduler.set_timesteps(num_inference_steps, device=start_latents.device)
-        # Reversed timesteps <<<<<<<<<<<<<<<<<<<<
-        timesteps = reversed(self.scheduler.timesteps)
-        for i in range(1, num_inference_steps): # range(1, num_inference_steps):
-            if i >= start_timestep: continue
+        # Reversed timesteps <<<<<<<<<<<<<<<<<<<< (한 번만 flip한 tensor, t = timesteps[i]는 0-d tensor)
+        timesteps = torch.flip(self.scheduler.timesteps, dims=[0]).to(start_latents.device)
+        # alpha 값은 loop 전에 device 위에서 미리 indexing (step마다 .item() sync 제거)
+        step_ratio = 1000 // num_inference_steps
+        alphas_cumprod = self.scheduler.alphas_cumprod.to(start_latents.device)
+        alphas_prev = alphas_cumprod[(timesteps - step_ratio).clamp_min(0)]  # current_t = max(0, t - step_ratio)
+        alphas_next = alphas_cumprod[timesteps]                             # next_t = t
+        # step별 계수도 미리 계산 -> loop 안에는 sqrt/div 없이 fused update만 남음
+        coefs_x = alphas_next.sqrt() / alphas_prev.sqrt()
+        coefs_eps = (1 - alphas_next).sqrt() - (1 - alphas_prev).sqrt() * coefs_x
+        # i >= start_timestep인 step은 건너뛰므로 loop 범위 자체를 줄임 (UNet 호출: start_timestep - 1회)
+        for i in range(1, min(start_timestep, num_inference_steps)):
             t = timesteps[i]
             # print(t)
             # Expand the latents if we are doing classifier free guidance
-            latent_model_input = torch.cat([latents] * 2) if do_cfg else latents
+            latent_model_input = self._cfg_latent_input(latents) if do_cfg else latents
             latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-            noise_pred = self.unet(
-                latent_model_input, t,
-                encoder_hidden_states=generated_prompt_embeds,
-                encoder_hidden_states_1=prompt_embeds,
-                encoder_attention_mask_1=attention_mask,
-            ).sample
+            with self._autocast():
+                noise_pred = self.unet(
+                    latent_model_input, t,
+                    encoder_hidden_states=generated_prompt_embeds,
+                    encoder_hidden_states_1=prompt_embeds,
+                    encoder_attention_mask_1=attention_mask,
+                ).sample
+            noise_pred = noise_pred.float()  # inversion update는 FP32
             # Perform guidance
             if do_cfg:
-                noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
-            current_t = max(0, t.item() - (1000//num_inference_steps)) # t # max(0, t.item() - (1000//num_inference_steps))
-            next_t = t # min(999, t.item() + (1000//num_inference_steps))   # t
-            alpha_t = self.scheduler.alphas_cumprod[current_t]
-            alpha_t_next = self.scheduler.alphas_cumprod[next_t]
+                noise_pred = self._cfg_guidance(noise_pred, guidance_scale)
             # Inverted update step (re-arranging the update step to get x(t) (new latents) as a function of x(t-1) (current latents)
-            latents = (latents - (1-alpha_t).sqrt()*noise_pred)*(alpha_t_next.sqrt()/alpha_t.sqrt()) + (1-alpha_t_next).sqrt()*noise_pred
+            latents = _ddim_inv_step(latents, noise_pred, coefs_x[i], coefs_eps[i])
         return latents
 
 
@@ -485,8 +693,31 @@ class AudioLDM2(nn.Module):
 
 
 if __name__ == '__main__':
-    audioldm = AudioLDM(device='cpu')
-    mel = torch.randn(size=(3,8,256,16))
+    audioldm = AudioLDM2(device='cuda' if torch.cuda.is_available() else 'cpu')
+
+    # encode_prompt가 pipe.encode_prompt와 같은 결과를 내는지 확인
+    caption = 'A cat meowing and footstep on the wooden floor'
+    ours = audioldm.encode_prompt([caption], batch_size=2)
+    torch.manual_seed(0)
+    ref = audioldm.pipe.encode_prompt(prompt=[caption] * 2, device=audioldm.device,
+                                      do_classifier_free_guidance=True, num_waveforms_per_prompt=1)
+    for name, x, y in zip(['prompt_embeds', 'attention_mask', 'generated_prompt_embeds'], ours, ref):
+        assert x.shape == y.shape, (name, x.shape, y.shape)
+        print(name, (x.float() - y.float()).abs().max().item())
+
+    # 여러 caption을 batch로 encode했을 때 k번째 row가 단독 encode_prompt([text_k])와 같은지 확인 (padding 부분은 0)
+    captions = [caption, 'A dog barking', 'A man speaking while a car engine idles in the background']
+    K, B = len(captions), 2
+    batched = audioldm.encode_prompt(captions, batch_size=B)
+    for k, text in enumerate(captions):
+        single = audioldm.encode_prompt([text], batch_size=B)
+        rows = torch.cat([torch.arange(k * B, (k + 1) * B), torch.arange((K + k) * B, (K + k + 1) * B)])
+        for name, x, y in zip(['prompt_embeds', 'attention_mask', 'generated_prompt_embeds'], batched, single):
+            x = x[rows.to(x.device)]
+            assert torch.equal(x[:, :y.size(1)], y), (name, text)
+            assert not x[:, y.size(1):].any(), (name, text)
+
+    mel = torch.randn(size=(3,8,256,16), device=audioldm.device)
     # wav = audioldm.encode_audios(mel)
     wav = audioldm.ddim_noising(mel)
     print(wav.shape);print(wav.dtype)
@@ -75,13 +75,15 @@ class AudioDataProcessor():
         return origin_wav
 
     ### 범용 용도 wav ###
-    def read_wav_file(self, filename):  # fname → np[1,N]
+    def read_wav_file(self, filename, duration=None):  # fname → np[1,N]
+        # duration: 지정하면 self.duration 대신 사용 (processor 상태를 바꾸지 않음)
+        duration = self.duration if duration is None else duration
         # 1. file load
         wav, raw_sr = torchaudio.load(filename, normalize=True)  # ts[C,N'±]
         # 2. to mono channel
         wav = wav.mean(dim=0) if wav.shape[0] > 1 else wav  # ts[1,N'±]
         # 2. segment & padding (to target length)
-        raw_length = int(raw_sr * self.duration)
+        raw_length = int(raw_sr * duration)
         wav = self.segment_wav(wav, raw_length)  # ts[1,N'-]
         wav = self.pad_wav(wav, raw_length)      # ts[1,N']
         # 3. resampling
@@ -3,6 +3,7 @@ import sys
 import re
 from typing import Dict, List
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 proj_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 src_dir = os.path.join(proj_dir, 'src')
@@ -29,7 +30,7 @@ from src.audioldm import AudioLDM
 from src.audioldm2 import AudioLDM2
 
 from src.dataprocessor import AudioDataProcessor
-from src.sep_editing import inference
+from src.sep_editing import inference, edit_mels_batched, read_wav_pair
 
 import torchaudio
 
@@ -104,6 +105,20 @@ class AudioCapsEvaluator:
         self.eval_list = eval_list
         self.audio_dir = f'data/audiocaps'
 
+    def _parse_eval_data(self, eval_data):
+        # idx, caption, labels, _, _ = eval_data
+        idx, caption, labels, _, _, mixed_caption = eval_data
+
+        source_path = os.path.join(self.audio_dir, f'segment-{idx}.wav')
+        mixture_path = os.path.join(self.audio_dir, f'mixture-{idx}.wav')
+                        
+        if self.query == 'caption':
+            text = [caption]
+        elif self.query == 'labels':
+            text = [labels]
+        mixed_text = [mixed_caption]
+        return source_path, mixture_path, text, mixed_text
+
     def __call__(self, pl_model, config) -> Dict:
         r"""Evalute."""
         print(f'Evaluation on AudioCaps with [{self.query}] queries.')
@@ -117,34 +132,57 @@ class AudioCapsEvaluator:
         sisdrs_list = []
         sdris_list = []
         samples = config['samples']
-        
-        for eval_data in tqdm(self.eval_list[:samples]):
-
-            # idx, caption, labels, _, _ = eval_data
-            idx, caption, labels, _, _, mixed_caption = eval_data
-
-            source_path = os.path.join(self.audio_dir, f'segment-{idx}.wav')
-            mixture_path = os.path.join(self.audio_dir, f'mixture-{idx}.wav')
-                            
-            if self.query == 'caption':
-                text = [caption]
-            elif self.query == 'labels':
-                text = [labels]
-            mixed_text = [mixed_caption]
-
-            config['mixed_text'] = mixed_text[0]
-            config['text'] = text[0]
-
-            sisdr_li, sdri_li = inference(audioldm, processor,
-                      target_path=source_path,
-                      mixed_path=mixture_path,
-                      config=config)
-
-            sisdr_li.append(caption)
-            sdri_li.append(caption)
-
-            sisdrs_list.append(sisdr_li)
-            sdris_list.append(sdri_li)
+        eval_list = self.eval_list[:samples]
+
+        # eval_batch개 sample의 iter 0 editing을 한 번에 UNet에 통과 (AudioLDM2만 지원)
+        eval_batch = config.get('eval_batch', 1)
+        batched = eval_batch > 1
+        if batched and not hasattr(audioldm, 'edit_audio_with_ddim_batched'):
+            raise ValueError(f"eval_batch={eval_batch} requires a model with edit_audio_with_ddim_batched "
+                             f"(AudioLDM2), got {type(audioldm).__name__}")
+        init_mel_samples = None
+
+        # 다음 sample들의 wav load/resample을 thread pool에서 미리 수행 (GPU 연산과 overlap)
+        # batched면 다음 chunk 전체가 필요하므로 eval_batch만큼 더 앞서 읽음
+        prefetch = 2 + (eval_batch if batched else 0)
+        def load_wavs(eval_data):
+            source_path, mixture_path, _, _ = self._parse_eval_data(eval_data)
+            return read_wav_pair(processor, source_path, mixture_path)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(load_wavs, d) for d in eval_list[:prefetch]]
+
+            for i, eval_data in enumerate(tqdm(eval_list)):
+                if i + prefetch < len(eval_list):
+                    futures.append(executor.submit(load_wavs, eval_list[i + prefetch]))
+                wavs = futures[i].result()
+
+                source_path, mixture_path, text, mixed_text = self._parse_eval_data(eval_data)
+                caption = eval_data[1]
+
+                config['mixed_text'] = mixed_text[0]
+                config['text'] = text[0]
+
+                if batched and i % eval_batch == 0:
+                    chunk = range(i, min(i + eval_batch, len(eval_list)))
+                    init_mel_samples = edit_mels_batched(audioldm, processor,
+                                                         mixed_wavs=[futures[j].result()[1] for j in chunk],
+                                                         texts=[self._parse_eval_data(eval_list[j])[2][0] for j in chunk],
+                                                         config=config)
+                futures[i] = None
+
+                sisdr_li, sdri_li = inference(audioldm, processor,
+                          target_path=source_path,
+                          mixed_path=mixture_path,
+                          config=config,
+                          init_mel_samples=init_mel_samples[i % eval_batch] if batched else None,
+                          wavs=wavs)
+
+                sisdr_li.append(caption)
+                sdri_li.append(caption)
+
+                sisdrs_list.append(sisdr_li)
+                sdris_list.append(sdri_li)
             
         sisdrs_array = np.array(sisdrs_list)  # (samples, iterations)
         sdris_array = np.array(sdris_list)    # (samples, iterations)
@@ -205,17 +243,16 @@ if __name__ == "__main__":
     # mean_sisdr, mean_sdri = eval((processor, audioldm), config)
     sisdr_array, sdri_array = eval((processor, audioldm), config)
 
-    def format_number(num):
-        num = float(num)  # 문자열이 아니라 숫자로 변환
-        formatted = f"{num:.4f}"
-        return formatted if num < 0 else f" {formatted}"
+    def format_numbers(arr):
+        arr = arr.astype(np.float64)  # 문자열이 아니라 숫자로 변환
+        # 음수가 아니면 부호 자리만큼 공백을 붙여 정렬
+        return np.char.add(np.where(arr < 0, '', ' '), np.char.mod('%.4f', arr))
 
-    vec_format = np.vectorize(format_number)
-    formatted_sisdrs = vec_format(sisdr_array[:, :5].astype(float))
-    formatted_sdris = vec_format(sdri_array[:, :5].astype(float))
+    formatted_sisdrs = format_numbers(sisdr_array[:, :5])
+    formatted_sdris = format_numbers(sdri_array[:, :5])
 
-    combined_data = np.core.defchararray.add(formatted_sisdrs, ' / ')
-    combined_data = np.core.defchararray.add(combined_data, formatted_sdris)
+    combined_data = np.char.add(formatted_sisdrs, ' / ')
+    combined_data = np.char.add(combined_data, formatted_sdris)
 
     df = pd.DataFrame(combined_data)
     df['caption'] = sisdr_array[:, 5].astype(str)  # caption 데이터는 sisdrs_array의 마지막 열 사용
@@ -95,7 +95,66 @@ def test_wav2stft2wav_reconstruction(wavpath, fname='000000.wav'):
     recon_wav = recon_wav.squeeze()
     sf.write('./test/wav2stft2wav/000000.wav', recon_wav, 16000)
 
-def inference(audioldm, processor, target_path, mixed_path, config):
+BATCH_SPLIT = 4  # edit 한 번에 batchsize // BATCH_SPLIT 개씩 생성
+
+def edit_kwargs(config):
+    r"""inference / edit_mels_batched 공통 editing 설정."""
+    return dict(
+        duration=10.24,
+        transfer_strength=config['strength'],
+        guidance_scale=2.5,
+        ddim_steps=config['steps'],
+        clipping=False,
+        return_type="mel",
+    )
+
+def prepare_mixture(processor, mixed_wav):  # np[1,N/2] -> np[1,N], ts[1,N], ts[1,1,1024,64]
+    mixed_wav = np.concatenate([mixed_wav, mixed_wav], axis=1)
+    assert mixed_wav.ndim == 2 and mixed_wav.shape[1] == 163840, mixed_wav.shape
+    mixed_wav_ = processor.prepare_wav(mixed_wav)
+    mixed_mel = processor.wav_to_mel(mixed_wav_)
+    return mixed_wav, mixed_wav_, mixed_mel
+
+def edit_mels_batched(audioldm, processor, mixed_wavs, texts, config):
+    r"""iter 0의 mel editing을 여러 sample에 대해 한 번에 수행 (AudioLDM2 전용).
+    Args:
+        mixed_wavs (List[np.ndarray]), `read_wav_pair`로 읽은 mixture wav np[1,N] K개
+        texts (List[str]), 각 mixture에 대응하는 text K개
+    Returns:
+        List[torch.Tensor], sample별 ts[batchsize, 1, 1024, 64] K개 (`inference`의 init_mel_samples로 사용)
+    """
+    batchsize = config['batchsize']
+    K = len(mixed_wavs)
+
+    mixed_mel_list = []
+    for mixed_wav in mixed_wavs:
+        _, _, mixed_mel = prepare_mixture(processor, mixed_wav)
+        mixed_mel_list.append(mixed_mel)
+
+    batchsize_ = batchsize // BATCH_SPLIT
+    ref_mels = torch.cat(mixed_mel_list, dim=0).repeat_interleave(batchsize_, dim=0)  # [K*batchsize_,1,1024,64]
+    prompt_embeds, attention_mask, generated_prompt_embeds = audioldm.encode_prompt(texts, batch_size=batchsize_)
+
+    mel_sample_list = []
+    for i in range(BATCH_SPLIT):
+        mel_samples = audioldm.edit_audio_with_ddim_batched(
+                    mel=ref_mels,
+                    prompt_embeds=prompt_embeds,
+                    attention_mask=attention_mask,
+                    generated_prompt_embeds=generated_prompt_embeds,
+                    **edit_kwargs(config),
+                )
+        mel_sample_list.append(mel_samples.view(K, batchsize_, *mel_samples.shape[1:]))
+    mel_samples = torch.cat(mel_sample_list, dim=1)  # [K,batchsize,1,1024,64]
+    return list(mel_samples.unbind(0))
+
+def read_wav_pair(processor, target_path, mixed_path, duration=5.12):  # -> np[1,N], np[1,N]
+    # processor 상태를 바꾸지 않으므로 worker thread에서 호출해도 됨
+    target_wav = processor.read_wav_file(target_path, duration=duration)
+    mixed_wav = processor.read_wav_file(mixed_path, duration=duration)
+    return target_wav, mixed_wav
+
+def inference(audioldm, processor, target_path, mixed_path, config, init_mel_samples=None, wavs=None):
     device = audioldm.device
     learning_rate = config['learning_rate']
     num_epochs = config['num_epochs']
@@ -103,7 +162,6 @@ def inference(audioldm, processor, target_path, mixed_path, config):
     strength = config['strength']
     iteration = config['iteration']
     text = config['text']
-    steps = config['steps']
     mixed_text = config['mixed_text']
 
     iter_sisdrs = []
@@ -113,20 +171,17 @@ def inference(audioldm, processor, target_path, mixed_path, config):
     criterion = nn.MSELoss()
     optimizer = optim.Adam(mask.parameters(), lr=learning_rate)
 
+    # wavs: 미리 읽어둔 (target_wav, mixed_wav) (e.g. evaluator의 prefetch). 없으면 여기서 한 번만 읽음
+    if wavs is None:
+        wavs = read_wav_pair(processor, target_path, mixed_path)
+
     for iter in range(iteration):
         processor.duration = 5.12
-        target_wav = processor.read_wav_file(target_path)
-        mixed_wav = processor.read_wav_file(mixed_path)
+        target_wav, mixed_wav = wavs
         target_wav = np.concatenate([target_wav, target_wav], axis=1)
-        mixed_wav = np.concatenate([mixed_wav, mixed_wav], axis=1)
-        assert mixed_wav.ndim == 2 and mixed_wav.shape[1] == 163840, mixed_wav.shape
-
-
-        mixed_wav_ = processor.prepare_wav(mixed_wav)
+        mixed_wav, mixed_wav_, mixed_mel = prepare_mixture(processor, mixed_wav)
         mixed_stft, mixed_stft_c = processor.wav_to_stft(mixed_wav_)
-        mixed_mel = processor.wav_to_mel(mixed_wav_)
-        batch_split = 4
-        batchsize_ = batchsize // batch_split
+        batchsize_ = batchsize // BATCH_SPLIT
         mixed_mels = mixed_mel.repeat(batchsize_, 1, 1, 1)
         ref_mels = mixed_mels
         
@@ -135,43 +190,23 @@ def inference(audioldm, processor, target_path, mixed_path, config):
             masked_wav_ = processor.prepare_wav(masked_wav)
             masked_stft, masked_stft_c = processor.wav_to_stft(masked_wav_)
             masked_mel = processor.wav_to_mel(masked_wav_)
-            batch_split = 4
-            batchsize_ = batchsize // batch_split
             masked_mels = mixed_mel.repeat(batchsize_, 1, 1, 1)
             ref_mels = masked_mels
 
-        if iter == 0:
+        if iter == 0 and init_mel_samples is not None:
+            # edit_mels_batched로 미리 생성한 결과 사용
+            mel_sample_list = [init_mel_samples]
+
+        else:
             mel_sample_list=[]
-            for i in range(batch_split):
+            for i in range(BATCH_SPLIT):
                 # edit_audio_with_ddim_inversion_sampling
                 mel_samples = audioldm.edit_audio_with_ddim(
                             mel=ref_mels,
                             # original_text=mixed_text,
                             text=text,
-                            duration=10.24,
-                            batch_size=batchsize_,
-                            transfer_strength=strength,
-                            guidance_scale=2.5,
-                            ddim_steps=steps,
-                            clipping = False,
-                            return_type="mel",
-                        )
-                mel_sample_list.append(mel_samples)
-            
-        elif iter != 0:
-            mel_sample_list=[]
-            for i in range(batch_split):
-                mel_samples = audioldm.edit_audio_with_ddim(
-                            mel=ref_mels,
-                            # original_text=mixed_text,
-                            text=text,
-                            duration=10.24,
                             batch_size=batchsize_,
-                            transfer_strength=strength,
-                            guidance_scale=2.5,
-                            ddim_steps=steps,
-                            clipping = False,
-                            return_type="mel",
+                            **edit_kwargs(config),
                         )
                 mel_sample_list.append(mel_samples)
         mel_samples = torch.cat(mel_sample_list, dim=0)